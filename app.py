@@ -1,38 +1,57 @@
 import streamlit as st
-import io
-import os
+import itertools
 import tempfile
 import zipfile
-import base64
-import uuid
-from reportlab.pdfgen import canvas
+import xxhash
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
-from PyPDF2 import PdfReader, PdfWriter
-from reportlab.platypus import Paragraph
-from reportlab.lib.styles import ParagraphStyle
-from reportlab.lib.enums import TA_CENTER
+
+from certificates import (
+    CertConfig,
+    build_combined_pdf,
+    generate_certificates,
+    parse_template,
+    process_certificate,
+    write_zip_entries,
+)
 
 # For PDF to image conversion (deployment-friendly preview)
-from pdf2image import convert_from_bytes
+import pymupdf
 from PIL import Image
 
 st.set_page_config(page_title="Certificate Generator", layout="wide")
 st.title("Certificate Generator")
 
-# Initialize session state for font tracking
-if "name_font_id" not in st.session_state:
-    st.session_state.name_font_id = None
-if "text_font_id" not in st.session_state:
-    st.session_state.text_font_id = None
-if "name_font_file_hash" not in st.session_state:
-    st.session_state.name_font_file_hash = None
-if "text_font_file_hash" not in st.session_state:
-    st.session_state.text_font_file_hash = None
+# Initialize session state for template tracking
+if "template_file_hash" not in st.session_state:
+    st.session_state.template_file_hash = None
+if "template" not in st.session_state:
+    st.session_state.template = None
 if "template_dimensions" not in st.session_state:
     st.session_state.template_dimensions = (841.89, 595.276)  # Default A4 landscape
 
 
+# Helper function to get file hash for checking if it's changed
+def get_file_hash(file):
+    if file is None:
+        return None
+
+    # The upload shares Streamlit's stored bytes, which getvalue() returns
+    # as they are; getbuffer() would first copy them to unshare the buffer
+    return xxhash.xxh3_64_intdigest(file.getvalue())
+
+
+def load_template(template_file):
+    """Parse the uploaded template once and reuse it until the file changes."""
+    file_hash = get_file_hash(template_file)
+    if file_hash != st.session_state.template_file_hash:
+        # The bytes are read once here and shared by the reader and the pdfrw
+        # form; forked worker processes inherit the parsed result
+        st.session_state.template = parse_template(template_file.getvalue())
+        st.session_state.template_file_hash = file_hash
+    return st.session_state.template
+
+
 # Function to detect PDF dimensions
 def detect_pdf_dimensions(pdf_file):
     """Detect the width and height of the uploaded PDF template."""
@@ -40,14 +59,11 @@ def detect_pdf_dimensions(pdf_file):
         return st.session_state.template_dimensions  # Return default dimensions
 
     try:
-        pdf = PdfReader(io.BytesIO(pdf_file.getvalue()))
-        if len(pdf.pages) > 0:
-            # Get the first page
-            page = pdf.pages[0]
-            # Extract media box dimensions (in points)
-            media_box = page.mediabox
-            width = float(media_box.width)
-            height = float(media_box.height)
+        # The first page size is read once when the template is parsed, so
+        # reruns only look it up on the cached template
+        size = load_template(pdf_file).size
+        if size is not None:
+            width, height = size
             # Store in session state
             st.session_state.template_dimensions = (width, height)
             return width, height
@@ -103,166 +119,97 @@ with st.sidebar:
     desc_max_width = st.number_input("Description Max Width", value=550, step=10)
 
 
+def build_config(name_font, text_font):
+    """Collect the layout settings and fonts passed to the rendering workers."""
+    return CertConfig(
+        page_size=(page_width, page_height),
+        name_xy=(name_x, name_y),
+        desc_xy=(desc_x, desc_y),
+        date_xy=(date_x, date_y),
+        name_font_size=name_font_size,
+        desc_font_size=desc_font_size,
+        date_font_size=date_font_size,
+        desc_max_width=desc_max_width,
+        name_font=name_font,
+        text_font=text_font,
+    )
+
+
+# Rasterize the first page once per PDF; reruns with the same bytes hit the cache
+@st.cache_data(max_entries=8, show_spinner=False)
+def rasterize_pdf(pdf_bytes):
+    """Render the first page of the PDF to an image in-process with PyMuPDF."""
+    with pymupdf.open(stream=pdf_bytes, filetype="pdf") as doc:
+        pix = doc.load_page(0).get_pixmap(dpi=100)
+    return Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+
+
 # Function to display PDF (image-based for deployment compatibility)
 def display_pdf(pdf_bytes):
     """Display the PDF as an image for better compatibility with Streamlit deployment."""
     try:
         # Try to convert the first page of the PDF to an image
-        images = convert_from_bytes(pdf_bytes, first_page=1, last_page=1)
-        if images:
-            st.image(images[0], caption="Certificate Preview", use_column_width=True)
-            return True
+        image = rasterize_pdf(pdf_bytes)
     except Exception as e:
         st.warning(
             f"Could not generate preview image. Using download option instead. Error: {str(e)}"
         )
+        # No image could be rendered; callers always offer the download button
         return False
 
-    # Fallback: Try iframe method (works locally but may not work in deployment)
-    try:
-        base64_pdf = base64.b64encode(pdf_bytes).decode("utf-8")
-        pdf_display = f'<iframe src="data:application/pdf;base64,{base64_pdf}" width="100%" height="600" type="application/pdf"></iframe>'
-        st.markdown(pdf_display, unsafe_allow_html=True)
-        return True
-    except:
-        return False
+    st.image(image, caption="Certificate Preview", use_column_width=True)
+    return True
 
 
-# Helper function to get file hash for checking if it's changed
-def get_file_hash(file):
-    if file is None:
-        return None
-    return hash(file.getvalue())
+# Functions for certificate generation
+@st.cache_resource(show_spinner=False)
+def register_font(file_hash, _font_file):
+    """Register a TTF font once per process and return its font name."""
+    # ReportLab's font registry is shared by every session, so the name is
+    # derived from the file hash and the same font is never parsed twice
+    font_id = f"font_{file_hash:016x}"
+
+    # TTFont reads straight from the uploaded file, no getvalue() copy needed
+    _font_file.seek(0)
+    pdfmetrics.registerFont(TTFont(font_id, _font_file))
+    return font_id
 
 
-# Functions for certificate generation
-def register_uploaded_font(font_file, font_type="name"):
+def register_uploaded_font(font_file):
     """Register uploaded font with a unique identifier and return font name."""
     if font_file is None:
         return "Helvetica"
 
-    # Calculate hash to detect changes
-    file_hash = get_file_hash(font_file)
-
-    # Check if the font has changed
-    if font_type == "name":
-        if file_hash == st.session_state.name_font_file_hash:
-            return (
-                st.session_state.name_font_id
-            )  # Return existing font id if not changed
-        st.session_state.name_font_file_hash = file_hash
-    else:  # text font
-        if file_hash == st.session_state.text_font_file_hash:
-            return (
-                st.session_state.text_font_id
-            )  # Return existing font id if not changed
-        st.session_state.text_font_file_hash = file_hash
-
-    # Create a unique font identifier
-    font_id = f"{font_type}_font_{uuid.uuid4().hex[:8]}"
-
-    # Create a temporary file
-    temp_dir = tempfile.mkdtemp()
-    temp_path = os.path.join(temp_dir, font_file.name)
-
-    # Save the uploaded font to the temporary file
-    with open(temp_path, "wb") as f:
-        f.write(font_file.getvalue())
-
-    # Register the font with the unique identifier
-    pdfmetrics.registerFont(TTFont(font_id, temp_path))
-
-    # Update session state with new font ID
-    if font_type == "name":
-        st.session_state.name_font_id = font_id
-    else:
-        st.session_state.text_font_id = font_id
+    # Fonts are cached by content, so re-uploads and new sessions reuse them
+    return register_font(get_file_hash(font_file), font_file)
 
-    return font_id
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def parse_names(text):
+    """Split the pasted names into a list, skipping blank and repeated lines."""
+    # A repeated name would render the same certificate again only to write
+    # it under the same file name, so each name is kept once, in input order
+    names = (name.strip() for name in text.splitlines())
+    return list(dict.fromkeys(name for name in names if name))
 
 
 def get_names():
     """Extract names from the text input."""
-    return [name.strip() for name in names_text.splitlines() if name.strip()]
-
-
-def add_name(c, name, coord, font_name, font_size):
-    """Add the name centered at the specified coordinate on the canvas."""
-    c.setFont(font_name, font_size)
-    c.drawCentredString(coord[0], coord[1], name)
-
-
-def add_description(c, description, coord, font_name, font_size, max_width=550):
-    """Add a centered, wrapped paragraph to the canvas using Platypus."""
-    style = ParagraphStyle(
-        name="Center",
-        fontName=font_name,
-        fontSize=font_size,
-        alignment=TA_CENTER,
-        leading=font_size * 1.3,
-    )
-
-    para = Paragraph(description, style)
-    width, height = para.wrap(max_width, 1000)
-    x = coord[0] - width / 2
-    y = coord[1] - height / 2
-    para.drawOn(c, x, y)
-
-
-def add_date(c, date_str, coord, font_name, font_size):
-    """Add the date centered at the specified coordinate."""
-    c.setFont(font_name, font_size)
-    c.drawCentredString(coord[0], coord[1], date_str)
-
-
-def merge_overlay(template_page, overlay_page):
-    """Merge the overlay page onto the template page."""
-    template_page.merge_page(overlay_page)
-    return template_page
-
-
-def process_certificate(template_pdf, name, description, date, name_font, text_font):
-    """Process a single certificate and return the PDF bytes."""
-    # Create a fresh reader copy for each certificate to avoid overlapping content
-    template_pdf_copy = PdfReader(io.BytesIO(template_file.getvalue()))
-    template_page = template_pdf_copy.pages[0]
-
-    # Create an in-memory overlay canvas
-    packet = io.BytesIO()
-    overlay_canvas = canvas.Canvas(packet, pagesize=(page_width, page_height))
-
-    # Add components to the overlay
-    add_name(overlay_canvas, name, (name_x, name_y), name_font, name_font_size)
-    add_description(
-        overlay_canvas,
-        description,
-        (desc_x, desc_y),
-        text_font,
-        desc_font_size,
-        desc_max_width,
-    )
-    add_date(overlay_canvas, date, (date_x, date_y), text_font, date_font_size)
-
-    # Finalize the canvas
-    overlay_canvas.showPage()
-    overlay_canvas.save()
-
-    # Move back to the beginning of the BytesIO stream
-    packet.seek(0)
-    overlay_pdf = PdfReader(packet)
-    overlay_page = overlay_pdf.pages[0]
-
-    # Merge the overlay with the template
-    merge_overlay(template_page, overlay_page)
-
-    # Create output PDF
-    output = io.BytesIO()
-    writer = PdfWriter()
-    writer.add_page(template_page)
-    writer.write(output)
-    output.seek(0)
-
-    return output
+    # Parsed once per distinct text, not again on the preview and submit reruns
+    return parse_names(names_text)
+
+
+def track_progress(entries, total, progress_bar):
+    """Pass the entries through while advancing the progress bar."""
+    # Every progress update is sent to the browser, so the bar only moves
+    # about a hundred times however many certificates there are
+    step = max(1, total // 100)
+    for done, entry in enumerate(entries, 1):
+        yield entry
+        if done % step == 0 or done == total:
+            progress_bar.progress(
+                done / total, text=f"Generated {done} of {total} certificates..."
+            )
 
 
 # Continue with the rest of the form
@@ -278,6 +225,12 @@ with st.form("certificate_form"):
         st.subheader("Names & Content")
         names_text = st.text_area("Enter names (one per line)")
         date_text = st.text_input("Certificate Date", "14 April 2025")
+        combined_pdf = st.checkbox("Also create a combined PDF with all certificates")
+        compress_zip = st.checkbox(
+            "Compress the ZIP file",
+            help="PDFs are already compressed, so this usually saves little "
+            "space and makes generation slower.",
+        )
 
     with col2:
         st.subheader("Certificate Description")
@@ -301,25 +254,26 @@ if st.button("Preview Certificate"):
     else:
         with preview_container:
             # Register fonts with unique identifiers
-            name_font = register_uploaded_font(name_font_file, "name")
-            text_font = register_uploaded_font(text_font_file, "text")
+            name_font = register_uploaded_font(name_font_file)
+            text_font = register_uploaded_font(text_font_file)
+            config = build_config(name_font, text_font)
+            template = load_template(template_file)
 
             # Get the first name for preview
             names = get_names()
             if names:
                 with st.spinner("Generating preview..."):
                     preview_pdf = process_certificate(
-                        None,
+                        template,
                         names[0],
                         description_text,
                         date_text,
-                        name_font,
-                        text_font,
+                        config,
                     )
 
                     # Display the PDF preview
                     st.success(f"Preview certificate for: {names[0]}")
-                    preview_success = display_pdf(preview_pdf.getvalue())
+                    preview_success = display_pdf(preview_pdf)
 
                     # Always provide a download option
                     st.download_button(
@@ -338,65 +292,97 @@ if submit_button:
         st.error("Please upload a PDF template file.")
     else:
         # Register fonts with unique identifiers
-        name_font = register_uploaded_font(name_font_file, "name")
-        text_font = register_uploaded_font(text_font_file, "text")
+        name_font = register_uploaded_font(name_font_file)
+        text_font = register_uploaded_font(text_font_file)
+        config = build_config(name_font, text_font)
+        template = load_template(template_file)
 
         # Get names
         names = get_names()
         if not names:
             st.error("No names provided. Please enter at least one name.")
         else:
-            # Create a zip file to hold all generated certificates
-            zip_buffer = io.BytesIO()
-            with zipfile.ZipFile(zip_buffer, "w") as zip_file:
-                with st.spinner(f"Generating {len(names)} certificates..."):
-                    for name in names:
-                        # Process the certificate
-                        pdf_bytes = process_certificate(
-                            None,  # Not used anymore as we create a fresh copy inside function
-                            name,
-                            description_text,
-                            date_text,
-                            name_font,
-                            text_font,
-                        )
-
-                        # Add the certificate to the zip file
-                        filename = f"{name.replace(' ', '_')}_katilimbelgesi.pdf"
-                        zip_file.writestr(filename, pdf_bytes.getvalue())
+            # Create a zip file to hold all generated certificates; the PDF
+            # streams are already compressed, so entries are stored as-is
+            # unless compression was asked for, and then at the fastest level
+            compression = zipfile.ZIP_DEFLATED if compress_zip else zipfile.ZIP_STORED
+            # The archive is built on disk, so memory use while generating stays
+            # at a few certificates however many names there are
+            with tempfile.TemporaryFile(suffix=".zip") as zip_tmp:
+                with zipfile.ZipFile(
+                    zip_tmp, "w", compression=compression, compresslevel=1
+                ) as zip_file:
+                    progress_bar = st.progress(
+                        0.0, text=f"Generating {len(names)} certificates..."
+                    )
+
+                    # Process all certificates across the available CPU cores,
+                    # adding each one to the zip file as it is finished
+                    generated = generate_certificates(
+                        template,
+                        names,
+                        description_text,
+                        date_text,
+                        config,
+                    )
+
+                    # Keep the first certificate so the preview reuses its bytes
+                    # instead of rendering it a second time
+                    first_certificate = next(generated)
+                    write_zip_entries(
+                        zip_file,
+                        track_progress(
+                            itertools.chain([first_certificate], generated),
+                            len(names),
+                            progress_bar,
+                        ),
+                    )
+                    progress_bar.empty()
 
                     # Add a preview for the first certificate
-                    if names:
-                        preview_pdf = process_certificate(
-                            None,
-                            names[0],
-                            description_text,
-                            date_text,
-                            name_font,
-                            text_font,
-                        )
-                        zip_file.writestr("preview.pdf", preview_pdf.getvalue())
-
-                        # Show preview
-                        st.subheader("Generated Certificate Preview")
-                        display_pdf(preview_pdf.getvalue())
-                        st.download_button(
-                            label="Download Preview",
-                            data=preview_pdf,
-                            file_name=f"preview_{names[0].replace(' ', '_')}.pdf",
-                            mime="application/pdf",
-                        )
+                    preview_pdf = first_certificate[1]
+                    zip_file.writestr("preview.pdf", preview_pdf)
+
+                    # Show preview
+                    st.subheader("Generated Certificate Preview")
+                    display_pdf(preview_pdf)
+                    st.download_button(
+                        label="Download Preview",
+                        data=preview_pdf,
+                        file_name=f"preview_{names[0].replace(' ', '_')}.pdf",
+                        mime="application/pdf",
+                    )
+
+                # download_button keeps the data in memory, so read it back once
+                zip_tmp.seek(0)
+                zip_data = zip_tmp.read()
 
             # Provide download for the zip file
-            zip_buffer.seek(0)
             st.success(f"Generated {len(names)} certificates!")
             st.download_button(
                 label=f"Download All Certificates ({len(names)} files)",
-                data=zip_buffer,
+                data=zip_data,
                 file_name="certificates.zip",
                 mime="application/zip",
             )
 
+            # Provide all certificates as one multi-page PDF when requested
+            if combined_pdf:
+                with st.spinner("Combining certificates into a single PDF..."):
+                    combined_output = build_combined_pdf(
+                        template,
+                        names,
+                        description_text,
+                        date_text,
+                        config,
+                    )
+                st.download_button(
+                    label=f"Download Combined PDF ({len(names)} pages)",
+                    data=combined_output,
+                    file_name="certificates.pdf",
+                    mime="application/pdf",
+                )
+
 # Instructions
 with st.expander("How to Use"):
     st.markdown(
@@ -408,7 +394,10 @@ with st.expander("How to Use"):
     5. **Preview** - Click "Preview Certificate" to see how it will look
     6. **Generate certificates** - Create PDFs for all names
     
-    All certificates will be provided in a single ZIP file for download.
+    All certificates will be provided in a single ZIP file for download. Tick
+    the combined PDF option to also get them as one multi-page PDF. The ZIP is
+    stored uncompressed unless you tick the compression option, since PDFs
+    barely shrink any further.
     """
     )
 
@@ -420,22 +409,15 @@ with st.expander("Requirements"):
     ```
     streamlit
     reportlab
-    PyPDF2
-    pdf2image
+    pypdf
+    pdfrw
+    pymupdf
     pillow
-    poppler-utils  # System dependency for pdf2image
+    xxhash
     ```
     
     Install Python packages with: 
-    `pip install streamlit reportlab PyPDF2 pdf2image pillow`
-    
-    On Ubuntu/Debian systems, install poppler-utils with:
-    `apt-get install -y poppler-utils`
-    
-    For Streamlit Cloud deployment, create a packages.txt file with:
-    ```
-    poppler-utils
-    ```
+    `pip install streamlit reportlab pypdf pdfrw pymupdf pillow xxhash`
     
     Run with: `streamlit run app.py`
     """
@@ -0,0 +1,539 @@
+"""Certificate rendering shared by the Streamlit app and its worker processes."""
+
+import collections
+import copy
+import dataclasses
+import functools
+import io
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import pdfrw
+from pdfrw.buildxobj import pagexobj
+from pdfrw.toreportlab import makerl
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfgen import canvas
+from pypdf import PdfReader, PdfWriter
+from pypdf.generic import (
+    ArrayObject,
+    DecodedStreamObject,
+    DictionaryObject,
+    NameObject,
+    RectangleObject,
+)
+from reportlab.platypus import Paragraph
+from reportlab.lib.styles import ParagraphStyle
+from reportlab.lib.enums import TA_CENTER
+
+# Parsed template: the pypdf reader, the first page size (or None for an
+# empty PDF) and the first page as a pdfrw form XObject, or None when pdfrw
+# cannot read the file and pypdf stamps instead
+Template = collections.namedtuple("Template", ["reader", "size", "form"])
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class CertConfig:
+    """Page layout and registered font names shared by every certificate."""
+
+    page_size: tuple
+    name_xy: tuple
+    desc_xy: tuple
+    date_xy: tuple
+    name_font_size: int
+    desc_font_size: int
+    date_font_size: int
+    desc_max_width: int
+    name_font: str
+    text_font: str
+
+
+# Parsed template handed to each worker process by _init_worker
+_worker_template = None
+
+# Starting a worker process costs about as much as rendering a handful of
+# certificates, so every process rendering a batch, this one included,
+# gets at least this many names, and smaller batches skip the pool entirely
+MIN_NAMES_PER_WORKER = 8
+MIN_POOL_NAMES = 3 * MIN_NAMES_PER_WORKER
+
+
+def draw_text_at(c, x, y, text):
+    """Draw a line of text starting at x without measuring it again."""
+    # drawString/drawCentredString look up the string width on every call,
+    # even when the caller already knows where the text starts
+    text_object = c.beginText(x, y)
+    text_object.textLine(text)
+    c.drawText(text_object)
+
+
+def add_name(c, name, coord, font_name, font_size):
+    """Add the name centered at the specified coordinate on the canvas."""
+    c.setFont(font_name, font_size)
+    width = pdfmetrics.stringWidth(name, font_name, font_size)
+    draw_text_at(c, coord[0] - 0.5 * width, coord[1], name)
+
+
+@functools.lru_cache(maxsize=8)
+def description_style(font_name, font_size):
+    """Build the centered paragraph style used for the description."""
+    # Paragraphs only read their style, so one instance serves every layout
+    # with the same font, even after the description text is edited
+    return ParagraphStyle(
+        name="Center",
+        fontName=font_name,
+        fontSize=font_size,
+        alignment=TA_CENTER,
+        leading=font_size * 1.3,
+    )
+
+
+# The same description is laid out for the preview, the batch and every
+# worker chunk, so the wrapped paragraph is kept for reuse
+@functools.lru_cache(maxsize=8)
+def _wrapped_description(description, font_name, font_size, max_width):
+    """Build the centered description paragraph and wrap it using Platypus."""
+    para = Paragraph(description, description_style(font_name, font_size))
+    para.wrap(max_width, 1000)
+    return para
+
+
+def wrap_description(description, font_name, font_size, max_width=550):
+    """Return the wrapped description paragraph, laying it out only once."""
+    # drawOn keeps the canvas on the paragraph while drawing, so each caller,
+    # possibly on another Streamlit session thread, gets its own shallow copy
+    return copy.copy(_wrapped_description(description, font_name, font_size, max_width))
+
+
+def add_description(c, para, coord, form_name=None):
+    """Add a wrapped description paragraph centered at the specified coordinate."""
+    x = coord[0] - para.width / 2
+    y = coord[1] - para.height / 2
+    if form_name is None:
+        para.drawOn(c, x, y)
+        return
+
+    # Reference the description already recorded as a form on this canvas
+    c.saveState()
+    c.translate(x, y)
+    c.doForm(form_name)
+    c.restoreState()
+
+
+def record_description(c, para, form_name="description"):
+    """Record the wrapped description once as a form XObject on the canvas."""
+    c.beginForm(form_name)
+    para.drawOn(c, 0, 0)
+    c.endForm()
+    return form_name
+
+
+# The date is the same on every certificate of a batch, so it is measured
+# once; font names are derived from the font file hash, so their metrics
+# never change under the same name
+@functools.lru_cache(maxsize=8)
+def centred_x(text, x, font_name, font_size):
+    """Return the x coordinate at which text centered on x starts."""
+    return x - 0.5 * pdfmetrics.stringWidth(text, font_name, font_size)
+
+
+def add_date(c, date_str, coord, font_name, font_size):
+    """Add the date centered at the specified coordinate."""
+    c.setFont(font_name, font_size)
+    x = centred_x(date_str, coord[0], font_name, font_size)
+    draw_text_at(c, x, coord[1], date_str)
+
+
+def draw_overlay(c, name, para, date, config, desc_form=None):
+    """Draw the name, description and date of one certificate on the canvas."""
+    add_name(c, name, config.name_xy, config.name_font, config.name_font_size)
+    add_description(c, para, config.desc_xy, desc_form)
+    add_date(c, date, config.date_xy, config.text_font, config.date_font_size)
+
+
+def add_stream(writer, data, entries=None):
+    """Add a new uncompressed stream to the writer and return its reference."""
+    stream = DecodedStreamObject()
+    stream.set_data(data)
+    if entries:
+        stream.update(entries)
+    return writer._add_object(stream)
+
+
+def merge_overlay(writer, template_page, overlay_page):
+    """Return a copy of the template page with the overlay drawn on top of it."""
+    # merge_page parses and rewrites the whole template content stream for
+    # every certificate; instead the overlay is wrapped in a form XObject and
+    # the template's streams are only referenced, so the writer copies them
+    # as they are and shares them between pages of the same document
+    page = copy.copy(template_page)
+
+    overlay_form = add_stream(
+        writer,
+        overlay_page.get_contents().get_data(),
+        {
+            NameObject("/Type"): NameObject("/XObject"),
+            NameObject("/Subtype"): NameObject("/Form"),
+            NameObject("/BBox"): RectangleObject(overlay_page.mediabox),
+            NameObject("/Resources"): overlay_page["/Resources"].clone(writer),
+        },
+    )
+
+    # Register the form next to the template's own resources
+    resources = DictionaryObject()
+    if "/Resources" in template_page:
+        resources.update(template_page["/Resources"])
+    xobjects = DictionaryObject()
+    if "/XObject" in resources:
+        xobjects.update(resources["/XObject"])
+    form_name = "/CertificateOverlay"
+    while form_name in xobjects:
+        form_name += "_"
+    xobjects[NameObject(form_name)] = overlay_form
+    resources[NameObject("/XObject")] = xobjects
+    page[NameObject("/Resources")] = resources
+
+    # Isolate the template's graphics state, then draw the overlay form
+    contents = ArrayObject([add_stream(writer, b"q\n")])
+    if "/Contents" in template_page:
+        template_contents = template_page.raw_get("/Contents")
+        if isinstance(template_contents.get_object(), ArrayObject):
+            template_contents = template_contents.get_object()
+        else:
+            template_contents = [template_contents]
+        contents.extend(ref.clone(writer) for ref in template_contents)
+    contents.append(add_stream(writer, f"\nQ q {form_name} Do Q\n".encode()))
+
+    # pypdf duplicates every stream of a content array it has to clone, so
+    # the template streams are cloned above (once per writer) and the array
+    # is registered with the writer, which then keeps it as it is
+    page[NameObject("/Contents")] = writer._add_object(contents)
+
+    return page
+
+
+def certificate_filename(name):
+    """Return the file name used for a certificate inside the zip."""
+    return f"{name.replace(' ', '_')}_katilimbelgesi.pdf"
+
+
+def can_draw_as_form(page):
+    """Check whether the page looks the same when drawn as a pdfrw form."""
+    # pagexobj keeps only the content, placed from the media box origin, so
+    # rotated, offset or cropped pages and annotations such as links need
+    # the pypdf stamp path, which keeps the page itself
+    media_box = page.mediabox
+    return (
+        page.rotation % 360 == 0
+        and (float(media_box.left), float(media_box.bottom)) == (0, 0)
+        and tuple(page.cropbox) == tuple(media_box)
+        and not page.get("/Annots")
+    )
+
+
+def parse_template(template_bytes):
+    """Parse the template PDF and convert its first page to a reusable form XObject."""
+    # BytesIO over an immutable bytes object shares its buffer instead of copying
+    reader = PdfReader(io.BytesIO(template_bytes))
+
+    # Read the media box once; pypdf only resolves the objects leading to it
+    size = None
+    form = None
+    if len(reader.pages) > 0:
+        first_page = reader.pages[0]
+        media_box = first_page.mediabox
+        size = (float(media_box.width), float(media_box.height))
+
+        # pdfrw does not decrypt, so encrypted templates, even those opened
+        # with an empty user password, keep their streams on the stamp path
+        if not reader.is_encrypted and can_draw_as_form(first_page):
+            try:
+                form = pagexobj(pdfrw.PdfReader(fdata=template_bytes).pages[0])
+            except Exception:
+                # pdfrw cannot read every PDF; those are stamped with pypdf
+                form = None
+    return Template(reader, size, form)
+
+
+def release_form(form, c):
+    """Drop the ReportLab objects pdfrw cached on the form for a finished canvas."""
+    # makerl memoizes its conversion on every object it visits, keyed by the
+    # canvas document, which would otherwise keep each certificate in memory
+    stack = [form]
+    seen = set()
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+
+        cache = getattr(obj, "derived_rl_obj", None)
+        if cache:
+            cache.pop(c._doc, None)
+
+        if isinstance(obj, pdfrw.PdfDict):
+            stack.extend(value for _, value in obj.iteritems())
+        elif isinstance(obj, pdfrw.PdfArray):
+            stack.extend(obj)
+
+
+def render_certificate(template, name, para, date, config):
+    """Draw the template form and the certificate text on one canvas and return the PDF bytes."""
+    # ReportLab builds the whole document as one bytes object anyway, so there
+    # is no output buffer to write into and grow; the page keeps the template
+    # size, as it does when the template is stamped
+    c = canvas.Canvas(None, pagesize=template.size)
+
+    try:
+        # Draw the template page as the background, then the text on top
+        c.doForm(makerl(c, template.form))
+        draw_overlay(c, name, para, date, config)
+
+        c.showPage()
+        return c.getpdfdata()
+    finally:
+        # Also when drawing fails, so the session's template does not keep it
+        release_form(template.form, c)
+
+
+def build_overlay_batch(names, description, date, config):
+    """Draw one overlay page per name on a single canvas and return the parsed overlay PDF."""
+    # Create an in-memory overlay canvas shared by the whole batch; its
+    # streams are decoded again as soon as they are merged, so they are not
+    # compressed in the first place
+    packet = io.BytesIO()
+    overlay_canvas = canvas.Canvas(packet, pagesize=config.page_size, pageCompression=0)
+
+    # The description is the same for every name, so lay it out only once
+    para = wrap_description(
+        description,
+        config.text_font,
+        config.desc_font_size,
+        config.desc_max_width,
+    )
+    # and emit its glyphs once as a form that every page references
+    desc_form = record_description(overlay_canvas, para)
+
+    for name in names:
+        # Add components to the overlay
+        draw_overlay(overlay_canvas, name, para, date, config, desc_form)
+
+        # Start a new overlay page for the next name
+        overlay_canvas.showPage()
+
+    # Finalize the canvas once for all names
+    overlay_canvas.save()
+
+    # Move back to the beginning of the BytesIO stream
+    packet.seek(0)
+    return PdfReader(packet)
+
+
+def add_stamped_page(writer, template_pdf, overlay_page):
+    """Add a copy of the template page to the writer with the overlay merged on top."""
+    # The cached template page is left untouched; add_page then copies the
+    # stamped page and everything it references into the writer
+    template_page = merge_overlay(writer, template_pdf.pages[0], overlay_page)
+    return writer.add_page(template_page)
+
+
+def stamp_certificate(template_pdf, overlay_page):
+    """Merge an overlay page onto a copy of the template page and return the PDF bytes."""
+    writer = PdfWriter()
+    add_stamped_page(writer, template_pdf, overlay_page)
+
+    # Create output PDF
+    output = io.BytesIO()
+    writer.write(output)
+
+    return output.getvalue()
+
+
+def process_certificates(template, names, description, date, config):
+    """Process a batch of certificates, yielding (name, PDF bytes) for each name."""
+    if template.form is None:
+        # Stamp one overlay batch onto copies of the template page instead
+        overlay_pdf = build_overlay_batch(names, description, date, config)
+        for name, overlay_page in zip(names, overlay_pdf.pages):
+            yield name, stamp_certificate(template.reader, overlay_page)
+        return
+
+    # The description is the same for every name, so lay it out only once
+    para = wrap_description(
+        description,
+        config.text_font,
+        config.desc_font_size,
+        config.desc_max_width,
+    )
+    for name in names:
+        yield name, render_certificate(template, name, para, date, config)
+
+
+def process_certificate(template, name, description, date, config):
+    """Process a single certificate and return the PDF bytes."""
+    _, pdf_bytes = next(
+        process_certificates(template, [name], description, date, config)
+    )
+    return pdf_bytes
+
+
+def build_combined_pdf(template, names, description, date, config):
+    """Stamp every name onto its own page of a single PDF and return the PDF bytes."""
+    if template.form is None:
+        overlay_pdf = build_overlay_batch(names, description, date, config)
+
+        # One writer for all pages, so the template resources are written once
+        writer = PdfWriter()
+        for overlay_page in overlay_pdf.pages:
+            add_stamped_page(writer, template.reader, overlay_page)
+        output = io.BytesIO()
+        writer.write(output)
+        return output.getvalue()
+
+    c = canvas.Canvas(None, pagesize=template.size)
+
+    try:
+        # Every page draws the same form, so the template is stored only once
+        form_name = makerl(c, template.form)
+        para = wrap_description(
+            description,
+            config.text_font,
+            config.desc_font_size,
+            config.desc_max_width,
+        )
+        desc_form = record_description(c, para)
+        for name in names:
+            c.doForm(form_name)
+            draw_overlay(c, name, para, date, config, desc_form)
+            c.showPage()
+
+        return c.getpdfdata()
+    finally:
+        # Also when drawing fails, so the session's template does not keep it
+        release_form(template.form, c)
+
+
+def _init_worker(template):
+    """Keep the already parsed template for the lifetime of a worker process."""
+    global _worker_template
+    _worker_template = template
+
+
+def _worker(names, description, date, config):
+    """Render a chunk of names in a worker process and return (filename, bytes) pairs."""
+    return [
+        (certificate_filename(name), pdf_bytes)
+        for name, pdf_bytes in process_certificates(
+            _worker_template, names, description, date, config
+        )
+    ]
+
+
+def render_named_certificates(template, names, description, date, config):
+    """Render certificates in this process, yielding (filename, PDF bytes) pairs."""
+    for name, pdf_bytes in process_certificates(
+        template, names, description, date, config
+    ):
+        yield certificate_filename(name), pdf_bytes
+
+
+def generate_certificates(template, names, description, date, config):
+    """Yield (filename, PDF data) for every name, spreading the work over all CPU cores."""
+    cpu_count = os.cpu_count() or 1
+    # This process renders alongside the pool, so it takes one of the cores
+    pool_workers = min(cpu_count, len(names) // MIN_NAMES_PER_WORKER) - 1
+
+    # Workers are forked so they inherit the registered fonts and the parsed
+    # template without pickling or re-parsing it, and never re-run the
+    # Streamlit script; forking the threaded server is only safe on Linux
+    # (macOS offers fork but it can crash there), so elsewhere, and for
+    # batches too small to pay for starting a worker, the batch is rendered
+    # in-process
+    if (
+        len(names) < MIN_POOL_NAMES
+        or pool_workers < 1
+        or not sys.platform.startswith("linux")
+    ):
+        yield from render_named_certificates(template, names, description, date, config)
+        return
+
+    # Split the names into chunks, each rendered as one batch by a worker
+    chunksize = max(1, len(names) // (4 * cpu_count))
+    chunks = [names[i : i + chunksize] for i in range(0, len(names), chunksize)]
+
+    with ProcessPoolExecutor(
+        max_workers=pool_workers,
+        mp_context=multiprocessing.get_context("fork"),
+        initializer=_init_worker,
+        initargs=(template,),
+    ) as executor:
+        pending = collections.deque(chunks[1:])
+        running = set()
+
+        def submit_pending():
+            # Queue one chunk behind the one each worker is rendering, so the
+            # rest stay available for this process to take
+            while pending and len(running) < 2 * pool_workers:
+                chunk = pending.popleft()
+                running.add(executor.submit(_worker, chunk, description, date, config))
+
+        submit_pending()
+
+        # This process renders the first chunk itself instead of idling, so
+        # the first name still comes out first for the preview
+        yield from render_named_certificates(
+            template, chunks[0], description, date, config
+        )
+
+        # Pass finished chunks on in whatever order they finish, and keep
+        # rendering chunks no worker has taken until none are left
+        while pending or running:
+            finished = {future for future in running if future.done()}
+            running -= finished
+            for future in finished:
+                yield from future.result()
+            submit_pending()
+
+            if pending:
+                yield from render_named_certificates(
+                    template, pending.pop(), description, date, config
+                )
+            elif running:
+                wait(running, return_when=FIRST_COMPLETED)
+
+
+def write_zip_entries(zip_file, entries, backlog=8):
+    """Write (filename, bytes) entries into the zip on a background thread."""
+    # The caller's generator keeps rendering the next certificates while the
+    # writer thread stores the finished ones; the bounded queue keeps at most
+    # a few PDFs waiting in memory
+    pending = queue.Queue(maxsize=backlog)
+    errors = []
+
+    def writer():
+        while (entry := pending.get()) is not None:
+            # After a failure keep draining so the producer never blocks
+            if errors:
+                continue
+            try:
+                zip_file.writestr(*entry)
+            except Exception as e:
+                errors.append(e)
+
+    thread = threading.Thread(target=writer, daemon=True)
+    thread.start()
+    try:
+        for entry in entries:
+            # Stop rendering the rest of the batch once the zip cannot take it
+            if errors:
+                break
+            pending.put(entry)
+    finally:
+        pending.put(None)
+        thread.join()
+
+    if errors:
+        raise errors[0]